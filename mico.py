@@ -6,7 +6,7 @@ Find and process MIDI files.
 """
 
 # == imports ==
-import sys, argparse, os, re
+import sys, argparse, os, re, json, io, time
 import numpy as np
 import pmidi, mido
 import util
@@ -21,14 +21,28 @@ from npaux import *
 CONFIG = util.Bunch (
   collect = [],
   contiguous_notes = False,
+  drop_duplicates = False,
   dump = "",
+  dump_channel = [],
+  dump_format = 'table',
+  dump_ticks = "",
+  dump_track = [],
+  dump_type = [],
+  duplicate_threshold = 0.8,
   extension = [],
+  find_duplicates = False,
+  index_only = False,
   monophonic_notes = False,
   parse_collected = False,
   play = "",
+  prefetch = 8,
+  prefetch_mb = 64,
   randmidi = "",
+  stats = False,
+  table = "",
   transpose_to_c = False,
   verbose = 0,
+  where = "",
 )
 
 # == parse_options ==
@@ -37,56 +51,287 @@ def _parse_options ():
   a = p.add_argument
   a ('--collect', default = CONFIG.collect, action = 'append', help = "Collect files recursively")
   a ('--contiguous-notes', default = CONFIG.contiguous_notes, action = 'store_true', help = "Remove pauses and staccato")
+  a ('--drop-duplicates', default = CONFIG.drop_duplicates, action = 'store_true', help = "Skip tunes that duplicate previously parsed tunes")
   a ('--dump', type = str, default = CONFIG.dump, help = "Dump MIDI file events")
+  a ('--dump-channel', type = int, default = CONFIG.dump_channel, action = 'append', help = "Only dump events of MIDI channel (0-15)")
+  a ('--dump-format', default = CONFIG.dump_format, choices = ('table', 'json'), help = "Dump events as table or JSON lines")
+  a ('--dump-ticks', type = str, default = CONFIG.dump_ticks, help = "Only dump events in tick range START:END")
+  a ('--dump-track', type = int, default = CONFIG.dump_track, action = 'append', help = "Only dump events of track")
+  a ('--dump-type', type = str, default = CONFIG.dump_type, action = 'append', help = "Only dump events of message type")
+  a ('--duplicate-threshold', type = float, default = CONFIG.duplicate_threshold, help = "Minimum similarity at which tunes are duplicates")
   a ('--extension', default = CONFIG.extension, action = 'append', help = "Only collect files matching extension")
+  a ('--find-duplicates', default = CONFIG.find_duplicates, action = 'store_true', help = "Report near-duplicate collected tunes")
+  a ('--index-only', default = CONFIG.index_only, action = 'store_true', help = "Print a metadata table from skimming MIDI file headers")
   a ('--monophonic-notes', default = CONFIG.monophonic_notes, action = 'store_true', help = "Remove polyphonic notes (keeping the lead)")
   a ('--parse-collected', default = CONFIG.parse_collected, action = 'store_true', help = "Dump collected files")
   a ('--play', type = str, default = CONFIG.play, help = "Play a MIDI file")
+  a ('--prefetch', type = int, default = CONFIG.prefetch, help = "Number of MIDI files to read ahead (0 disables)")
+  a ('--prefetch-mb', type = int, default = CONFIG.prefetch_mb, help = "Limit read ahead buffers in MiB")
   a ('--randmidi', type = str, default = CONFIG.randmidi, help = "Generate a random MIDI file")
+  a ('--stats', default = CONFIG.stats, action = 'store_true', help = "Print time spent waiting on I/O versus decoding")
+  a ('--table', type = str, default = CONFIG.table, help = "Metadata table file, written by --parse-collected")
   a ('--transpose-to-c', default = CONFIG.transpose_to_c, action = 'store_true', help = "Transpose tunes into C")
   a ('-v', '--verbose', default = CONFIG.verbose, action = 'store_true', dest = 'verbose',
      help = "Increase output messages or debugging info")
+  a ('--where', type = str, default = CONFIG.where, help = "Print files from --table matching e.g. 'bpm>100 and nnotes>500'")
   return p.parse_args()
 
 # == MidiTune ==
+# Transforms return a new tune sharing `filename` and attrs, or with `inplace = True`
+# modify and return `self`, avoiding copies of an already owned notes buffer.
 class MidiTune:
-  def __init__ (self, filename, notes = [], attrs = {}):
+  def __init__ (self, filename, notes = [], attrs = {}, copy = True, onset_groups = None):
     self.__dict__.update (attrs)
     self.filename = filename
-    self.notes = np.copy (notes)
+    self.notes = np.copy (notes) if copy else np.asarray (notes)
+    self._onset_groups = onset_groups
+  @property
+  def notes (self):
+    return self._notes
+  @notes.setter
+  def notes (self, notes):
+    self._notes = np.asarray (notes)
+    self._onset_groups = None                                   # invalidate index of previous notes
   def __str__ (self):
     s = '<MidiTune'
-    for k,v in self.__dict__.items():
-      if k not in ('filename', 'notes'):
-        s += f' {k}={v}'
+    for k,v in self.attrs().items():
+      s += f' {k}={v}'
     s += ' notes.shape=' + str (self.notes.shape)
     s += '>'
     return s
-  def contiguous_notes (self, min_duration = 1 / 8, max_duration = 99e99):
-    return MidiTune ('', pmidi.contiguous_notes (self.notes, min_duration, max_duration))
-  def monophonic_notes (self):
-    return MidiTune ('', pmidi.monophonic_notes (self.notes))
-  def transpose_to_c (self):
-    return MidiTune ('', pmidi.transpose_to_c (self.notes))
-  def quantize_durations (self):
-    notes = np.copy (self.notes)
+  def attrs (self):
+    return { k: v for k,v in self.__dict__.items() if k != 'filename' and not k.startswith ('_') }
+  def copy (self):
+    return MidiTune (self.filename, self.notes, self.attrs(), copy = True)
+  def _derive (self, notes, inplace):
+    if inplace:
+      self.notes = notes
+      return self
+    return MidiTune (self.filename, notes, self.attrs(), copy = False)
+  def contiguous_notes (self, min_duration = 1 / 8, max_duration = 99e99, inplace = False):
+    return self._derive (pmidi.contiguous_notes (self.notes, min_duration, max_duration, copy = not inplace), inplace)
+  def monophonic_notes (self, inplace = False):
+    return self._derive (pmidi.monophonic_notes (self.notes, copy = not inplace, groups = self.onset_groups()), inplace)
+  def transpose_to_c (self, inplace = False):
+    return self._derive (pmidi.transpose_to_c (self.notes, copy = not inplace), inplace)
+  def onset_beats (self):
+    return np.cumsum (self.notes.reshape (-1, 3)[:,2], dtype = np.float64)
+  def onset_groups (self):
+    if self._onset_groups is None:                              # cached until notes are replaced
+      self._onset_groups = pmidi.onset_groups (self.notes)
+    return self._onset_groups
+  def chord_stats (self):
+    return pmidi.chord_stats (self.notes, self.onset_groups())
+  def chord_tokens (self):
+    return pmidi.chord_tokens (self.notes, self.onset_groups())
+  def onset_segmentation (self, segment_length):
+    return pmidi.onset_segmentation (self.notes, segment_length, self.onset_groups())
+  def _tempo_map (self):
+    return getattr (self, 'tempo_map', None) or pmidi.TempoMap.from_bpm (getattr (self, 'bpm', 120))
+  def onset_seconds (self):
+    return self._tempo_map().beats_to_seconds (self.onset_beats())
+  def duration_seconds (self):
+    notes = self.notes.reshape (-1, 3)
+    if len (notes) == 0:
+      return 0.0
+    return float (self._tempo_map().beats_to_seconds (np.max (self.onset_beats() + notes[:,1])))
+  def time_windows (self, seconds, hop = None):
+    notes = self.notes.reshape (-1, 3)
+    return [notes[b:e] for b, e in window_bounds (self.onset_seconds(), seconds, hop)]
+  def quantize_durations (self, inplace = False):
+    notes = self.notes if inplace else np.copy (self.notes)
     notes[:,1] = pmidi.quantize_durations (notes[:,1])
-    return MidiTune ('', notes)
+    return self._derive (notes, inplace)
+
+# == TuneTable ==
+# Column oriented table of per tune metadata, persisted as `.npz` and queried via sorted column indexes.
+class TuneTable:
+  COLUMNS = ('bpm', 'nnotes', 'nchords', 'min_pitch', 'max_pitch', 'key', 'duration', 'polyphony')
+  def __init__ (self):
+    self.filenames = np.zeros (0, dtype = str)
+    self.columns = { k: np.zeros (0, dtype = np.float64) for k in self.COLUMNS }
+    self.programs = np.zeros ((0, 16), dtype = np.uint8)       # bit set of 128 GM programs per tune
+    self.pending = []
+    self.indexes = {}
+  def __len__ (self):
+    self._flush()
+    return len (self.filenames)
+  def append (self, tune):
+    notes = tune.notes.reshape (-1, 3)
+    tstats = pmidi.tune_stats (notes) if len (notes) else util.Bunch (min_note = -1, max_note = -1, tonica = -1)
+    tempo_map = tune._tempo_map()
+    first_tick = tune.onset_beats()[0] * tempo_map.ticks_per_beat if len (notes) else 0
+    row = dict (bpm = tempo_map.bpm_at (first_tick), nnotes = getattr (tune, 'nnotes', len (notes)),
+                nchords = getattr (tune, 'nchords', 0), min_pitch = tstats.min_note, max_pitch = tstats.max_note,
+                key = tstats.tonica, duration = tune.duration_seconds(),
+                polyphony = float (np.mean (notes[1:,2] == 0)) if len (notes) > 1 else 0.0)
+    programs = np.zeros (128, dtype = bool)
+    programs[getattr (tune, 'programs', [])] = True
+    self.pending.append ((tune.filename, row, np.packbits (programs)))
+  def _flush (self):
+    if not self.pending:
+      return
+    filenames, rows, programs = zip (*self.pending)
+    self.filenames = np.concatenate ((self.filenames, filenames))
+    for k in self.COLUMNS:
+      self.columns[k] = np.concatenate ((self.columns[k], [row[k] for row in rows]))
+    self.programs = np.concatenate ((self.programs, programs))
+    self.pending, self.indexes = [], {}
+  def save (self, path):
+    self._flush()
+    with open (path, 'wb') as f:                               # np.savez would append '.npz'
+      np.savez (f, filenames = self.filenames, programs = self.programs, **self.columns)
+  @staticmethod
+  def load (path):
+    table = TuneTable()
+    with np.load (path, allow_pickle = False) as npz:
+      table.filenames, table.programs = npz['filenames'], npz['programs']
+      table.columns = { k: npz[k] for k in TuneTable.COLUMNS }
+    return table
+  def _index (self, column):
+    if column not in self.indexes:
+      order = np.argsort (self.columns[column], kind = 'stable')
+      self.indexes[column] = (order, self.columns[column][order])
+    return self.indexes[column]
+  def _select (self, column, op, value):
+    if column == 'programs':                                    # programs==P tests for use of program P
+      p = int (value)
+      if op != '==' or p < 0 or p > 127:
+        raise ValueError (f'invalid programs clause: {column}{op}{value}')
+      return ((self.programs[:, p >> 3] >> (7 - (p & 7))) & 1).astype (bool)
+    if column not in self.columns:
+      raise ValueError (f'unknown column: {column}')
+    if column == 'key' and value.capitalize() in pmidi.MIDI_PITCH_SEMITONE_NAMES:
+      value = pmidi.MIDI_PITCH_SEMITONE_NAMES.index (value.capitalize())
+    mask = np.zeros (len (self.filenames), dtype = bool)
+    order, svalues = self._index (column)
+    value = float (value)
+    lo, hi = np.searchsorted (svalues, value, 'left'), np.searchsorted (svalues, value, 'right')
+    ranges = { '==': (lo, hi), '<': (0, lo), '<=': (0, hi), '>': (hi, len (svalues)), '>=': (lo, len (svalues)) }
+    if op == '!=':
+      mask[:] = True
+      mask[order[lo:hi]] = False
+    else:
+      b, e = ranges[op]
+      mask[order[b:e]] = True
+    return mask
+  def query (self, where):
+    self._flush()
+    mask = np.ones (len (self.filenames), dtype = bool)
+    for clause in re.split (r'\s+and\s+', where.strip()) if where.strip() else []:
+      m = re.fullmatch (r'\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*([-+.#\w]+)\s*', clause)
+      if not m:
+        raise ValueError (f'invalid clause: {clause!r}')
+      mask &= self._select (*m.groups())
+    return self.filenames[mask].tolist()
 
 # == parse_midis ==
 # Parse and yield a MidiTune object for one or many MIDI files.
-def parse_midi (filenames, dedup = True):
-  for filename in util.as_list (filenames):
+# Files are read ahead on `prefetch` threads within `max_bytes`, see util.prefetch_files, `stats` accumulates timings.
+def parse_midi (filenames, dedup = True, prefetch = None, max_bytes = None, stats = None):
+  prefetch = CONFIG.prefetch if prefetch is None else prefetch
+  max_bytes = CONFIG.prefetch_mb << 20 if max_bytes is None else max_bytes
+  for filename, data in util.prefetch_files (filenames, prefetch, max_bytes, stats):
+    t0 = time.perf_counter()
     try:
-      mfile = mido.MidiFile (filename, clip = True)
+      if isinstance (data, Exception):
+        raise data
+      mfile = mido.MidiFile (file = io.BytesIO (data), clip = True)
     except Exception as ex:
       print (f'{filename}: error:', repr (ex), file = sys.stderr)
+      if stats:
+        stats.decode_time += time.perf_counter() - t0
       continue
     iset, xset = [], []
-    notes, attrs = pmidi.analyze_midi (mfile, iset, xset, dedup, verbose = CONFIG.verbose)
-    tune = MidiTune (filename, notes, attrs)
+    notes, attrs, groups = pmidi.analyze_midi (mfile, iset, xset, dedup, verbose = CONFIG.verbose)
+    tune = MidiTune (filename, notes, attrs, copy = False, onset_groups = groups)
+    if stats:
+      stats.decode_time += time.perf_counter() - t0
     yield tune
 
+# == parse_stats ==
+# Create a Bunch to collect I/O and decoding statistics from parse_midi or index_midi.
+def parse_stats():
+  return util.Bunch (files = 0, bytes = 0, io_wait = 0.0, read_time = 0.0, decode_time = 0.0)
+
+# == print_parse_stats ==
+# Print statistics collected by parse_midi or index_midi.
+def print_parse_stats (stats, file = sys.stderr):
+  print (f'files={stats.files} bytes={stats.bytes} io_wait={stats.io_wait:.3f}s',
+         f'read_time={stats.read_time:.3f}s decode_time={stats.decode_time:.3f}s', file = file)
+
+# == dump_midi ==
+# Print events streamed from a MIDI file, filtered by track, channel, message type and `START:END` tick range.
+def dump_midi (filename, tracks = (), channels = (), types = (), ticks = '', fmt = 'table', file = sys.stdout):
+  start, _, end = ticks.partition (':')
+  start, end = int (start or 0), int (end) if end else None
+  if fmt == 'table':
+    print ('%5s %9s %2s %-16s %s' % ('track', 'tick', 'ch', 'type', 'values'), file = file)
+  for ev in pmidi.midi_events (filename, set (tracks) or None, end):
+    if (ev['tick'] < start or
+        (channels and ev.get ('channel') not in channels) or
+        (types and ev['type'] not in types)):
+      continue
+    if 'note' in ev:
+      ev['pitch_name'] = pitch_name (ev['note'])
+    if 'program' in ev:
+      ev['gm_instrument_name'] = gm_instrument_name (ev['program'])
+    if ev.get ('tempo', 0) > 0:
+      ev['bpm'] = round (mido.tempo2bpm (ev['tempo']), 3)
+    if fmt == 'json':
+      print (json.dumps (ev), file = file)
+    else:
+      values = ' '.join (f'{k}={v!r}' if isinstance (v, str) else f'{k}={v}' for k,v in ev.items()
+                         if k not in ('track', 'tick', 'channel', 'type'))
+      print ('%5d %9d %2s %-16s %s' % (ev['track'], ev['tick'], ev.get ('channel', '-'), ev['type'], values), file = file)
+
+# == index_midi ==
+# Skim one or many MIDI files without full parsing, yield a metadata Bunch per file.
+def index_midi (filenames, prefetch = None, max_bytes = None, stats = None):
+  prefetch = CONFIG.prefetch if prefetch is None else prefetch
+  max_bytes = CONFIG.prefetch_mb << 20 if max_bytes is None else max_bytes
+  for filename, data in util.prefetch_files (filenames, prefetch, max_bytes, stats):
+    t0 = time.perf_counter()
+    try:
+      if isinstance (data, Exception):
+        raise data
+      meta = pmidi.skim_midi (data)
+    except Exception as ex:
+      print (f'{filename}: error:', repr (ex), file = sys.stderr)
+      if stats:
+        stats.decode_time += time.perf_counter() - t0
+      continue
+    meta.filename = filename
+    if stats:
+      stats.decode_time += time.perf_counter() - t0
+    yield meta
+
+# == print_index ==
+# Print metadata from `index_midi` as tab separated table.
+INDEX_COLUMNS = ('filename', 'format', 'ntracks', 'ticks_per_beat', 'bpm', 'nnotes', 'ticks', 'programs')
+def print_index (metas, file = sys.stdout):
+  print ('\t'.join (INDEX_COLUMNS), file = file)
+  for meta in metas:
+    row = [getattr (meta, k) for k in INDEX_COLUMNS]
+    row[-1] = ','.join (str (p) for p in row[-1])
+    print ('\t'.join (str (v) for v in row), file = file)
+
+# == find_duplicates ==
+# Index tunes incrementally by MinHash over pitch interval n-grams, yield `(tune, duplicates)`.
+# Only originals are inserted into `lsh`, so `duplicates` lists `(similarity, filename)` of earlier tunes.
+def find_duplicates (tunes, threshold = 0.8, lsh = None):
+  lsh = MinHashLSH() if lsh is None else lsh
+  for tune in tunes:
+    ngrams = pmidi.interval_ngrams (tune.notes)
+    if len (ngrams) == 0:
+      yield tune, []
+      continue
+    sig = lsh.signature (ngrams)
+    duplicates = lsh.query (sig, threshold)
+    if not duplicates:
+      lsh.insert (tune.filename, sig)
+    yield tune, duplicates
+
 # == collect ==
 # Collect files recursively under `root`, filtered by matching `extension`.
 def collect (root, extension = None):
@@ -139,7 +384,10 @@ def _main (argv):
   CONFIG.verbose = True
   CONFIG = _parse_options()
   if CONFIG.dump:
-    print (mido.MidiFile (CONFIG.dump, clip = True))
+    try:
+      dump_midi (CONFIG.dump, CONFIG.dump_track, CONFIG.dump_channel, CONFIG.dump_type, CONFIG.dump_ticks, CONFIG.dump_format)
+    except (OSError, ValueError) as ex:
+      print (f'{CONFIG.dump}: error:', repr (ex), file = sys.stderr)
   if CONFIG.play:
     miditune = list (parse_midi (CONFIG.play))[0]
     play_notes (miditune.notes, miditune.bpm, CONFIG.verbose)
@@ -147,20 +395,47 @@ def _main (argv):
     random_midi (CONFIG.randmidi)
   if CONFIG.collect:
     collected = collect (CONFIG.collect, CONFIG.extension)
-    if CONFIG.parse_collected:
-      for tune in parse_midi (collected):
+    stats = parse_stats() if CONFIG.stats else None
+    if CONFIG.index_only:
+      print_index (index_midi (collected, stats = stats))
+    elif CONFIG.find_duplicates:
+      for tune, duplicates in find_duplicates (parse_midi (collected, stats = stats), CONFIG.duplicate_threshold):
+        if duplicates:
+          similarity, filename = duplicates[0]
+          print (f'{tune.filename}: duplicate of {filename} (similarity={similarity:.3f})')
+    elif CONFIG.parse_collected:
+      tunes = parse_midi (collected, stats = stats)
+      if CONFIG.drop_duplicates:
+        tunes = (tune for tune, duplicates in find_duplicates (tunes, CONFIG.duplicate_threshold) if not duplicates)
+      table = TuneTable() if CONFIG.table else None
+      for tune in tunes:
         print (tune.filename + ':', tune)
+        if table is not None:
+          table.append (tune)
         if CONFIG.monophonic_notes:
-          tune = tune.monophonic_notes()
+          tune.monophonic_notes (inplace = True)
         if CONFIG.contiguous_notes:
-          tune = tune.contiguous_notes()
+          tune.contiguous_notes (inplace = True)
         if CONFIG.transpose_to_c:
-          tune = tune.transpose_to_c()
+          tune.transpose_to_c (inplace = True)
         if tune.notes.any():
           print (tune.notes)
+      if table is not None:
+        table.save (CONFIG.table)
     else:
       print ('\n'.join (collected))
-  else:
+    if stats:
+      print_parse_stats (stats)
+  if CONFIG.where:
+    if not CONFIG.table:
+      print ('--where: error: missing --table', file = sys.stderr)
+      sys.exit (1)
+    try:
+      print ('\n'.join (TuneTable.load (CONFIG.table).query (CONFIG.where)))
+    except (OSError, ValueError) as ex:
+      print (f'{CONFIG.table}: error:', repr (ex), file = sys.stderr)
+      sys.exit (1)
+  elif not CONFIG.collect:
     print (__doc__)
   sys.exit (0)
 if __name__ == "__main__":
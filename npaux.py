@@ -1,21 +1,24 @@
 #!/usr/bin/env python
 # This Source Code Form is licensed MPL-2.0: http://mozilla.org/MPL/2.0
+import collections, queue, threading
+import concurrent.futures
 import numpy as np
 
-# == sequence_segmentation ==
-# Generate all segments of length segment_length from sequence, optionally with prefixed segments
-def sequence_segmentation (sequence, segment_length, prefix = None):
+# == iter_segmentation ==
+# Yield all segments of length segment_length from sequence, optionally with prefixed segments
+def iter_segmentation (sequence, segment_length, prefix = None):
   L = len (sequence)
-  segments = []
   if prefix != None:
     for i in range (segment_length-1, 0, -1):
       if len (sequence) >= segment_length - i:
-        seg = np.concatenate ((i * [prefix], sequence[0:segment_length - i]))
-        segments.append (seg)
+        yield np.concatenate ((i * [prefix], sequence[0:segment_length - i]))
   for i in range (L - segment_length + 1):
-    seg = sequence[i:i + segment_length]
-    segments.append (seg)
-  return segments
+    yield sequence[i:i + segment_length]
+
+# == sequence_segmentation ==
+# Generate all segments of length segment_length from sequence, optionally with prefixed segments
+def sequence_segmentation (sequence, segment_length, prefix = None):
+  return list (iter_segmentation (sequence, segment_length, prefix))
 assert np.prod (sequence_segmentation (10 + np.arange (5), 4, -1) ==    # [10, 11, 12, 13, 14]
                 np.array ([[-1, -1, -1, 10], [-1, -1, 10, 11],
                            [-1, 10, 11, 12], [10, 11, 12, 13], [11, 12, 13, 14]]))
@@ -29,6 +32,125 @@ def sequence_list_segmentation (sequence_list, segment_length, prefix = None):
     all_segments += segments
   return np.stack (all_segments, axis = 0)
 
+# == SegmentLoader ==
+# Produce batches of segments like `sequence_list_segmentation`, without materializing all segments.
+# Sources are assigned to `shard` of `num_shards` after a per epoch `shuffle`, so workers with equal
+# `seed` get disjoint, deterministic subsets. If given, `load` maps sources to sequences on `workers`
+# threads, and up to `prefetch` batches are assembled ahead of time on a background thread.
+class SegmentLoader:
+  def __init__ (self, sources, segment_length, batch_size = 32, prefix = None, load = None,
+                shuffle = True, shuffle_buffer = 4096, seed = 0, shard = 0, num_shards = 1, workers = 2, prefetch = 2, drop_last = False):
+    assert shard >= 0 and shard < num_shards
+    self.sources = sources
+    self.segment_length = segment_length
+    self.batch_size = batch_size
+    self.prefix = prefix
+    self.load = load
+    self.shuffle = shuffle
+    self.shuffle_buffer = shuffle_buffer
+    self.seed = seed
+    self.shard = shard
+    self.num_shards = num_shards
+    self.workers = workers
+    self.prefetch = prefetch
+    self.drop_last = drop_last
+    self.next_epoch = 0
+  def __iter__ (self):
+    epoch = self.next_epoch
+    self.next_epoch += 1
+    return self.epoch (epoch)
+  def epoch (self, epoch):
+    if self.prefetch <= 0:
+      return self._batches (epoch)
+    return self._prefetch (self._batches (epoch))
+  def _sequences (self, epoch):
+    order = np.arange (len (self.sources))
+    if self.shuffle:
+      np.random.default_rng ([self.seed, epoch]).shuffle (order)
+    order = order[self.shard::self.num_shards]
+    if self.load is None:
+      for ix in order:
+        yield self.sources[ix]
+      return
+    with concurrent.futures.ThreadPoolExecutor (max (1, self.workers)) as pool:
+      pending = collections.deque()
+      for ix in order:
+        pending.append (pool.submit (self.load, self.sources[ix]))
+        if len (pending) > 2 * self.workers:                    # bounded read-ahead
+          yield pending.popleft().result()
+      while pending:
+        yield pending.popleft().result()
+  def _batches (self, epoch):
+    rng = np.random.default_rng ([self.seed, epoch, self.shard])
+    buffer, batch = [], []
+    def segments():
+      for sequence in self._sequences (epoch):
+        for segment in iter_segmentation (sequence, self.segment_length, self.prefix):
+          if self.shuffle_buffer <= 1:
+            yield segment
+          elif len (buffer) < self.shuffle_buffer:
+            buffer.append (segment)
+          else:
+            j = rng.integers (len (buffer))                    # emit random element, keep new one
+            segment, buffer[j] = buffer[j], segment
+            yield segment
+      for j in rng.permutation (len (buffer)):
+        yield buffer[j]
+    for segment in segments():
+      batch.append (segment)
+      if len (batch) == self.batch_size:
+        yield np.stack (batch, axis = 0)
+        batch = []
+    if batch and not self.drop_last:
+      yield np.stack (batch, axis = 0)
+  def _prefetch (self, batches):
+    q, stop, done = queue.Queue (self.prefetch), threading.Event(), object()
+    def put (item):                                             # give up once the consumer stopped
+      while not stop.is_set():
+        try:
+          q.put (item, timeout = 0.1)
+          return True
+        except queue.Full:
+          pass
+      return False
+    def produce():
+      try:
+        for batch in batches:
+          if not put (batch):
+            return
+        put (done)
+      except BaseException as ex:
+        put (ex)
+    thread = threading.Thread (target = produce, daemon = True)
+    thread.start()
+    try:
+      while True:
+        item = q.get()
+        if item is done:
+          return
+        if isinstance (item, BaseException):
+          raise item
+        yield item
+    finally:
+      stop.set()
+assert (np.concatenate (list (SegmentLoader ([np.arange (5)], 4, 2, prefix = -1, prefetch = 0, shuffle = False, shuffle_buffer = 0))) ==
+        sequence_segmentation (np.arange (5), 4, -1)).all()
+
+# == window_bounds ==
+# Find `[begin, end)` index pairs into sorted `times` for windows of `length`, starting every `hop` from 0.
+def window_bounds (times, length, hop = None):
+  times = np.asarray (times)
+  hop = length if hop is None else hop
+  assert length > 0 and hop > 0
+  if len (times) == 0:
+    return np.zeros ((0, 2), dtype = np.int64)
+  starts = hop * np.arange (int (times[-1] // hop) + 1)
+  begins = np.searchsorted (times, starts, side = 'left')
+  ends = np.searchsorted (times, starts + length, side = 'left')
+  return np.stack ((begins, ends), axis = 1)
+assert (window_bounds ([0, 0.5, 1, 2.5], 1) == [[0, 2], [2, 3], [3, 4]]).all()
+assert (window_bounds ([0, 0.5, 1, 2.5], 2, 1) == [[0, 3], [2, 4], [3, 4]]).all()
+
 # == make_rows_unique ==
 # Remove non-unique rows from `array`, possibly inspecting `duparray` to determine uniqueness.
 def make_rows_unique (array, duparray = None):
@@ -207,3 +329,57 @@ class Mirostat2:
     self.cross_entropy_count += 1
 
     return sample
+
+# == mix64 ==
+# Scramble uint64 values with the SplitMix64 finalizer, a cheap but well distributed integer hash.
+def mix64 (x):
+  x = np.array (x, dtype = np.uint64)
+  x = (x ^ (x >> np.uint64 (30))) * np.uint64 (0xbf58476d1ce4e5b9)
+  x = (x ^ (x >> np.uint64 (27))) * np.uint64 (0x94d049bb133111eb)
+  return x ^ (x >> np.uint64 (31))
+
+# == MinHashLSH ==
+# Index sets of uint64 values by MinHash signatures, with LSH banding for sublinear lookup.
+# Signatures of two sets agree in a fraction of positions that estimates their Jaccard similarity,
+# signatures that agree in all `rows` of any of the `bands` end up in a common candidate bucket.
+class MinHashLSH:
+  def __init__ (self, num_perm = 128, bands = 32, seed = 0x6d69636f):
+    assert num_perm % bands == 0
+    self.num_perm = num_perm
+    self.bands = bands
+    self.rows = num_perm // bands
+    self.seeds = mix64 (seed + np.arange (num_perm, dtype = np.uint64))
+    self.buckets = [ {} for b in range (bands) ]
+    self.keys = []
+    self.signatures = []
+  def __len__ (self):
+    return len (self.keys)
+  def signature (self, values, chunk = 4096):
+    values = np.asarray (values, dtype = np.uint64).ravel()
+    sig = np.full (self.num_perm, np.iinfo (np.uint64).max, dtype = np.uint64)
+    for i in range (0, len (values), chunk):                   # bound the (chunk, num_perm) temporary
+      hashes = mix64 (values[i:i + chunk, None] ^ self.seeds[None,:])
+      sig = np.minimum (sig, hashes.min (axis = 0))
+    return sig
+  def _band_keys (self, sig):
+    return [ sig[b * self.rows:(b + 1) * self.rows].tobytes() for b in range (self.bands) ]
+  def insert (self, key, sig):
+    ix = len (self.keys)
+    self.keys.append (key)
+    self.signatures.append (sig)
+    for bucket, bkey in zip (self.buckets, self._band_keys (sig)):
+      bucket.setdefault (bkey, []).append (ix)
+  def query (self, sig, threshold = 0.0):
+    candidates = set()
+    for bucket, bkey in zip (self.buckets, self._band_keys (sig)):
+      candidates.update (bucket.get (bkey, ()))
+    matches = []
+    for ix in sorted (candidates):
+      similarity = float (np.mean (self.signatures[ix] == sig))
+      if similarity >= threshold:
+        matches.append ((similarity, self.keys[ix]))
+    return sorted (matches, key = lambda m: -m[0])
+_lsh = MinHashLSH (16, 4)
+_lsh.insert ('abc', _lsh.signature ([1, 2, 3]))
+assert _lsh.query (_lsh.signature ([3, 2, 1])) == [(1.0, 'abc')] and _lsh.query (_lsh.signature ([7])) == []
+del _lsh
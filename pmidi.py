@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # This Source Code Form is licensed MPL-2.0: http://mozilla.org/MPL/2.0
-import os, subprocess, tempfile
+import os, subprocess, tempfile, struct, mmap
 import collections, mido
 import numpy as np
 from util import Bunch
@@ -8,13 +8,14 @@ from util import Bunch
 # == collect notes ==
 class NoteCollection:
   def __init__ (self, ticks_per_beat):
-    self.midi_tempo = None
+    self.tempo_changes = []
     self.ticks_per_beat = ticks_per_beat
     self.notes = []
     self.voices = {}
   @property
-  def bpm (self):
-    return 120 if self.midi_tempo == None else round (mido.tempo2bpm (self.midi_tempo) * 8192) / 8192
+  def bpm (self):                                               # tempo at the first note
+    first_tick = min ((note.tick for note in self.notes), default = 0)
+    return TempoMap (self.ticks_per_beat, self.tempo_changes).bpm_at (first_tick)
   class Note:
     def __init__ (self, notecollection, track, channel, tick, pitch, velocity, program):
       self.track = track
@@ -37,8 +38,8 @@ class NoteCollection:
     for msg in track:
       tick += msg.time
       # SET_TEMPO
-      if msg.type == 'set_tempo' and len (self.notes) < 1:
-        self.midi_tempo = msg.tempo # use last tempo before notes start
+      if msg.type == 'set_tempo':
+        self.tempo_changes.append ((tick, msg.tempo))
       # PROGRAM_CHANGE
       if msg.type == 'program_change':
         programs[msg.channel] = msg.program
@@ -74,6 +75,44 @@ class NoteCollection:
     if deduped and verbose:
       print ("deduped %d notes" % deduped)
 
+# == TempoMap ==
+# Piecewise constant tempo from all `set_tempo` events, for vectorized tick <-> seconds conversion.
+class TempoMap:
+  def __init__ (self, ticks_per_beat, tempo_changes = ()):
+    self.ticks_per_beat = ticks_per_beat
+    changes = sorted ((tt for tt in tempo_changes if tt[1] > 0), key = lambda tt: tt[0])  # last tempo per tick wins
+    ticks = np.array ([0] + [tick for tick, tempo in changes], dtype = np.float64)
+    tempos = np.array ([500000] + [tempo for tick, tempo in changes], dtype = np.float64) # default 120 BPM
+    keep = np.append (ticks[1:] != ticks[:-1], True)
+    self.ticks, self.tempos = ticks[keep], tempos[keep]
+    self.seconds_per_tick = self.tempos * 1e-6 / ticks_per_beat
+    self.seconds = np.concatenate (([0], np.cumsum (np.diff (self.ticks) * self.seconds_per_tick[:-1])))
+  @staticmethod
+  def from_bpm (bpm = 120):
+    return TempoMap (1, [(0, mido.bpm2tempo (bpm))])
+  def __len__ (self):
+    return len (self.ticks)
+  def __str__ (self):
+    return f'<TempoMap tempos={len (self)}>'
+  def bpm_at (self, tick):
+    tempo = self.tempos[max (0, np.searchsorted (self.ticks, tick, side = 'right') - 1)]
+    return round (mido.tempo2bpm (tempo) * 8192) / 8192
+  def ticks_to_seconds (self, ticks):
+    ticks = np.asarray (ticks, dtype = np.float64)
+    ix = np.maximum (np.searchsorted (self.ticks, ticks, side = 'right') - 1, 0)
+    return self.seconds[ix] + (ticks - self.ticks[ix]) * self.seconds_per_tick[ix]
+  def seconds_to_ticks (self, seconds):
+    seconds = np.asarray (seconds, dtype = np.float64)
+    ix = np.maximum (np.searchsorted (self.seconds, seconds, side = 'right') - 1, 0)
+    return self.ticks[ix] + (seconds - self.seconds[ix]) / self.seconds_per_tick[ix]
+  def beats_to_seconds (self, beats):
+    return self.ticks_to_seconds (np.asarray (beats, dtype = np.float64) * self.ticks_per_beat)
+  def seconds_to_beats (self, seconds):
+    return self.seconds_to_ticks (seconds) / self.ticks_per_beat
+assert (TempoMap (480, [(960, 250000), (0, 600000), (0, 500000)]).ticks_to_seconds ([0, 480, 960, 1920]) == [0, 0.5, 1, 1.5]).all()
+assert (TempoMap (480, [(960, 250000)]).seconds_to_beats ([0.5, 1, 1.5]) == [1, 2, 4]).all()
+assert TempoMap (480, [(0, 0), (960, 250000)]).bpm_at (0) == 120 and TempoMap (480, [(960, 250000)]).bpm_at (960) == 240
+
 # == filter_melody ==
 def filter_melody (note):
   if note.channel == 9: # MIDI Drums are on Channel 10
@@ -86,15 +125,10 @@ def filter_melody (note):
 # == notes_to_vector
 def notes_to_vector (midi_notes, verbose):
   notes = []
-  nnotes, nchords, prevstep = 0, 0, 0
   def add_note (mpitch, qlen, step):
-    nonlocal nnotes, nchords, prevstep
     # while mpitch < minfold: mpitch += 12
     # while mpitch > maxfold: mpitch -= 12
     notes.append ((mpitch, qlen, step))
-    nnotes += step != 0
-    nchords += step == 0 and prevstep > 0
-    prevstep = step
   ticks_per_beat = midi_notes[0].notecollection.ticks_per_beat if midi_notes else 0
   last_tick = 0
   iprograms = set()
@@ -111,7 +145,10 @@ def notes_to_vector (midi_notes, verbose):
   if verbose:
     for p in iprograms:
       print ("MIDI Program: Used:", p, GENERAL_MIDI_LEVEL1_INSTRUMENT_PATCH_MAP[p])
-  return nnotes - nchords, nchords, np.array (notes, dtype = np.float32)
+  npvec = np.array (notes, dtype = np.float32)
+  groups = onset_groups (npvec)
+  cstats = chord_stats (npvec, groups)
+  return cstats.nsteps - cstats.nchords, cstats.nchords, npvec, groups
 
 # == analyze_midi ==
 def analyze_midi (mfile, iset, xset, dedup, verbose):
@@ -136,12 +173,175 @@ def analyze_midi (mfile, iset, xset, dedup, verbose):
   # sort by tick, duration
   midi_notes = sorted (midi_notes, key = lambda nn: (nn.tick, nn.pitch, nn.channel, -nn.duration, nn.track))
   # create vector
-  nnotes, nchords, npvec = notes_to_vector (midi_notes, verbose = verbose)
+  nnotes, nchords, npvec, groups = notes_to_vector (midi_notes, verbose = verbose)
   # collect attrs
-  attrs['bpm'] = nc.bpm
+  tempo_map = TempoMap (nc.ticks_per_beat, nc.tempo_changes)
+  attrs['bpm'] = tempo_map.bpm_at (midi_notes[0].tick if midi_notes else 0)    # tempo at the first note
+  attrs['tempo_map'] = tempo_map
   attrs['nnotes'] = nnotes
   attrs['nchords'] = nchords
-  return npvec, attrs
+  attrs['programs'] = sorted (set (nn.program for nn in midi_notes))
+  return npvec, attrs, groups
+
+# == _read_vlq ==
+# Decode a MIDI variable-length quantity at `data[i]`, return position after it and value.
+def _read_vlq (data, i):
+  b = data[i]; i += 1
+  value = b & 0x7f
+  while b & 0x80:
+    b = data[i]; i += 1
+    value = (value << 7) | (b & 0x7f)
+  return i, value
+
+# == _scan_track ==
+# Walk the events of a track chunk `data[i:end]`, yield `(tick, status, meta_type, pos, length)` per event,
+# with event data at `data[pos:pos+length]`. Like mido, meta events keep the running status, while sysex
+# and system common messages cancel it. System common and real-time messages are not valid in SMF, their
+# data bytes are skipped. Scanning stops at end of track or truncation, a data byte without status raises.
+def _scan_track (data, i, end):
+  tick, status = 0, 0                                           # status holds the running status
+  try:
+    while i < end:
+      b = data[i]; i += 1                                       # delta time, VLQ
+      delta = b & 0x7f
+      while b & 0x80:
+        b = data[i]; i += 1
+        delta = (delta << 7) | (b & 0x7f)
+      tick += delta
+      if data[i] & 0x80:
+        s = data[i]; i += 1
+        if s < 0xf0:
+          status = s
+      elif status:
+        s = status
+      else:
+        raise ValueError ('running status without status byte at offset %d' % i)
+      if s < 0xf0:                                              # channel message
+        n = 1 if s & 0xe0 == 0xc0 else 2                        # program change, channel pressure
+        if i + n > end:
+          return
+        yield tick, s, None, i, n
+        i += n
+      elif s == 0xff:                                           # meta event
+        mtype = data[i]
+        i, mlen = _read_vlq (data, i + 1)
+        if i + mlen > end:
+          return
+        yield tick, s, mtype, i, mlen
+        i += mlen
+        if mtype == 0x2f:                                       # end of track
+          return
+      elif s == 0xf0 or s == 0xf7:                              # sysex
+        i, mlen = _read_vlq (data, i)
+        if i + mlen > end:
+          return
+        yield tick, s, None, i, mlen
+        i += mlen
+        status = 0
+      else:
+        i += MIDI_SYSTEM_DATA_LENGTHS.get (s, 0)
+        if s < 0xf8:                                            # real-time keeps running status
+          status = 0
+  except IndexError:
+    return                                                      # truncated track
+MIDI_SYSTEM_DATA_LENGTHS = { 0xf1: 1, 0xf2: 2, 0xf3: 1 }
+assert [e[:2] for e in _scan_track (b'\0\x90\x3c\x40\0\xff\x01\2hi\x60\x3c\0\0\x3e\x40\x60\x3e\0\0\xff\x2f\0', 0, 23)] == \
+  [(0, 0x90), (0, 0xff), (96, 0x90), (96, 0x90), (192, 0x90), (192, 0xff)]
+
+# == skim_midi ==
+# Index an SMF byte buffer by reading chunk headers and skimming track events, without creating messages.
+# Yields format, track count, ticks per beat, tempo at the first note, GM programs, note-on count and length in ticks.
+def skim_midi (data):
+  data = bytes (data)
+  if data[:4] != b'MThd' or len (data) < 14:
+    raise ValueError ('missing MThd chunk')
+  hlen = int.from_bytes (data[4:8], 'big')
+  fmt, ntracks, division = struct.unpack ('>HHH', data[8:14])
+  tempo_changes, first_note = [], None                         # first_note tick excludes drums
+  programs, nnotes, ticks, ntrk = set(), 0, 0, 0
+  pos = 8 + hlen
+  while pos + 8 <= len (data):
+    clen = int.from_bytes (data[pos + 4:pos + 8], 'big')
+    if data[pos:pos + 4] == b'MTrk':
+      ntrk += 1
+      for tick, status, mtype, i, n in _scan_track (data, pos + 8, min (len (data), pos + 8 + clen)):
+        kind = status & 0xf0
+        if kind == 0x90:
+          if data[i + 1] > 0:                                   # note-on with velocity
+            nnotes += 1
+            if status & 0x0f != 9 and (first_note is None or tick < first_note):
+              first_note = tick
+        elif kind == 0xc0:
+          if status & 0x0f != 9:                                # ignore drum kits
+            programs.add (data[i] & 0x7f)
+        elif status == 0xff and mtype == 0x51 and n == 3:
+          tempo_changes.append ((tick, int.from_bytes (data[i:i + 3], 'big')))
+        ticks = max (ticks, tick)
+    pos += 8 + clen
+  return Bunch (format = fmt,
+                ntracks = ntrk,
+                ticks_per_beat = division if division < 0x8000 else 0,  # 0 for SMPTE timing
+                bpm = TempoMap (max (1, division), tempo_changes).bpm_at (first_note or 0),  # as analyze_midi
+                programs = sorted (programs),
+                nnotes = nnotes,
+                ticks = ticks)
+assert vars (skim_midi (b'MThd\0\0\0\6\0\0\0\1\1\xe0MTrk\0\0\0\x15\0\xff\x51\3\x07\xa1\x20\0\xc0\x28\0\x90\x3c\x40\x60\x3c\0\0\xff\x2f\0')) == \
+  dict (format = 0, ntracks = 1, ticks_per_beat = 480, bpm = 120, programs = [40], nnotes = 1, ticks = 96)
+assert skim_midi (b'MThd\0\0\0\6\0\0\0\1\1\xe0MTrk\0\0\0\x0c\0\xf2\0\0\0\x90\x3c\x40\0\xff\x2f\0').nnotes == 1
+assert vars (skim_midi (b'MThd\0\0\0\6\0\0\0\1\0\x60MTrk\0\0\0\x1e\0\x90\x3c\x40\0\xff\x01\2hi\x60\x3c\0\0\x3e\x40\x60\x3e\0\0\xff\x51\3\0\0\0\0\xff\x2f\0')) == \
+  dict (format = 0, ntracks = 1, ticks_per_beat = 96, bpm = 120, programs = [], nnotes = 2, ticks = 192)
+
+# == midi_events ==
+# Stream events of an SMF file as dicts, decoded track by track from a memory map of the file.
+# Tracks not in `tracks` are skipped unread, decoding of a track stops after `max_tick`.
+def midi_events (filename, tracks = None, max_tick = None):
+  with open (filename, 'rb') as f:
+    if os.fstat (f.fileno()).st_size < 14:
+      raise ValueError ('missing MThd chunk')
+    with mmap.mmap (f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+      if data[:4] != b'MThd':
+        raise ValueError ('missing MThd chunk')
+      pos, ntrk = 8 + int.from_bytes (data[4:8], 'big'), 0
+      while pos + 8 <= len (data):
+        clen = int.from_bytes (data[pos + 4:pos + 8], 'big')
+        if data[pos:pos + 4] == b'MTrk':
+          if tracks is None or ntrk in tracks:
+            yield from _track_events (ntrk, data, pos + 8, min (len (data), pos + 8 + clen), max_tick)
+          ntrk += 1
+        pos += 8 + clen
+MIDI_CHANNEL_MESSAGES = { 0x80: ('note_off', 'note', 'velocity'), 0x90: ('note_on', 'note', 'velocity'),
+                          0xa0: ('polytouch', 'note', 'value'), 0xb0: ('control_change', 'control', 'value'),
+                          0xc0: ('program_change', 'program'), 0xd0: ('aftertouch', 'value'), 0xe0: ('pitchwheel', 'pitch') }
+MIDI_META_MESSAGES = { 0x00: 'sequence_number', 0x01: 'text', 0x02: 'copyright', 0x03: 'track_name', 0x04: 'instrument_name',
+                       0x05: 'lyrics', 0x06: 'marker', 0x07: 'cue_marker', 0x20: 'channel_prefix', 0x21: 'midi_port',
+                       0x2f: 'end_of_track', 0x51: 'set_tempo', 0x54: 'smpte_offset', 0x58: 'time_signature',
+                       0x59: 'key_signature', 0x7f: 'sequencer_specific' }
+def _track_events (track_idx, data, i, end, max_tick):
+  for tick, status, mtype, i, n in _scan_track (data, i, end):
+    if max_tick is not None and tick > max_tick:
+      return
+    ev = { 'track': track_idx, 'tick': tick }
+    payload = data[i:i + n]
+    if status == 0xff:                                          # meta event
+      ev['type'] = MIDI_META_MESSAGES.get (mtype, 'meta_0x%02x' % mtype)
+      if mtype == 0x51 and n == 3:
+        ev['tempo'] = int.from_bytes (payload, 'big')
+      elif mtype >= 0x01 and mtype <= 0x0f:
+        ev['text'] = payload.decode ('latin1')
+      elif mtype != 0x2f:
+        ev['data'] = payload.hex()
+    elif status == 0xf0 or status == 0xf7:                      # sysex
+      ev['type'] = 'sysex'
+      ev['data'] = payload.hex()
+    else:
+      mtype, *fields = MIDI_CHANNEL_MESSAGES[status & 0xf0]
+      ev['type'] = mtype
+      ev['channel'] = status & 0x0f
+      if mtype == 'pitchwheel':
+        ev['pitch'] = (payload[0] | payload[1] << 7) - 8192
+      else:
+        ev.update (zip (fields, payload))
+    yield ev
 
 # == count_pitches ==
 def pitch_stats (tune):
@@ -364,30 +564,70 @@ GENERAL_MIDI_LEVEL1_INSTRUMENT_PATCH_MAP = [
   "Guitar Fret Noise", "Breath Noise", "Seashore", "Bird Tweet", "Telephone Ring", "Helicopter", "Applause", "Gunshot",
 ]
 
+# == onset_groups ==
+# Index simultaneous notes CSR style, `notes[groups[g]:groups[g+1]]` are the notes of onset group `g`.
+# A group starts at each note with non-zero step, followed by the 0-step notes sounding with it.
+def onset_groups (notes):
+  steps = np.asarray (notes).reshape (-1, 3)[:,2]
+  L = len (steps)
+  starts = np.flatnonzero (steps[1:] != 0) + 1
+  return np.concatenate (([0], starts, [L] if L else [])).astype (np.int64)
+assert (onset_groups ([[60,1,0], [64,1,0], [62,1,1], [65,1,1], [69,1,0]]) == [0, 2, 3, 5]).all()
+assert (onset_groups (np.zeros ((0, 3))) == [0]).all()
+
+# == chord_stats ==
+# Count non-zero steps, chords (groups of several notes after a step) and maximum polyphony.
+def chord_stats (notes, groups = None):
+  notes = np.asarray (notes).reshape (-1, 3)
+  groups = onset_groups (notes) if groups is None else groups
+  sizes = np.diff (groups)
+  return Bunch (nsteps = int (np.count_nonzero (notes[:,2])),
+                nchords = int (np.count_nonzero ((sizes > 1) & (notes[groups[:-1],2] > 0))),
+                max_polyphony = int (sizes.max()) if len (sizes) else 0)
+
+# == onset_segmentation ==
+# Generate all segments of `segment_length` notes that start at an onset group, not within a chord.
+def onset_segmentation (notes, segment_length, groups = None):
+  notes = np.asarray (notes).reshape (-1, 3)
+  groups = onset_groups (notes) if groups is None else groups
+  starts = groups[:-1][groups[:-1] + segment_length <= len (notes)]
+  if len (starts) == 0:
+    return np.zeros ((0, segment_length, 3), dtype = notes.dtype)
+  windows = np.lib.stride_tricks.sliding_window_view (notes, segment_length, axis = 0)  # (N-L+1, 3, L)
+  return windows[starts].transpose (0, 2, 1)
+assert onset_segmentation ([[60,1,0], [64,1,0], [62,1,1], [65,1,1], [69,1,0]], 2)[:,:,0].tolist() == [[60, 64], [62, 65], [65, 69]]
+
+# == chord_tokens ==
+# Convert notes into a `(groups, 128)` boolean matrix, with the pitches sounding at each onset group.
+def chord_tokens (notes, groups = None):
+  notes = np.asarray (notes).reshape (-1, 3)
+  groups = onset_groups (notes) if groups is None else groups
+  ngroups = len (groups) - 1
+  tokens = np.zeros ((ngroups, 128), dtype = bool)
+  group_ids = np.repeat (np.arange (ngroups), np.diff (groups))
+  tokens[group_ids, np.clip (notes[:,0], 0, 127).astype (np.int64)] = True
+  return tokens
+
 # == monophonic_notes ==
-# Reduce polyphonic notes by removing notes to retain a monophonic tune.
-def monophonic_notes (origtune):
-  tune = np.copy (origtune)
-  i = 0                                         # position to search for polyphony
-  while i < len (tune):
-    e = i                                       # probe for 0-step notes following i
-    while e+1 < len (tune) and tune[e+1][2] == 0:
-      e += 1
-    if e > i:                                   # e is last index of 0-step subsequence
-      note = tune[i]                            # collapse into position i
-      poly = tune[i:e+1]                        # polyphony subsequence
-      for p, d, s in poly:
-        note[0] = max (note[0], p)              # pick remaining pitch
-        note[1] = max (note[1], d)              # pick longest duration
-      tune = np.delete (tune, np.arange (i, e), axis = 0)
-      tune[i,:] = note
-    i += 1
-  return tune
+# Reduce polyphonic notes by removing notes to retain a monophonic tune, keeping the highest
+# pitch and longest duration of each onset group.
+# With `copy = False`, `origtune` is compacted in place and a view of its head is returned.
+def monophonic_notes (origtune, copy = True, groups = None):
+  tune = np.copy (origtune) if copy else origtune
+  groups = onset_groups (tune) if groups is None else groups
+  starts = groups[:-1]
+  n = len (starts)
+  if n < len (tune):
+    pitches = np.maximum.reduceat (tune[:,0], starts)         # pick remaining pitch
+    durations = np.maximum.reduceat (tune[:,1], starts)       # pick longest duration
+    steps = tune[starts,2]
+    tune[:n,0], tune[:n,1], tune[:n,2] = pitches, durations, steps
+  return tune[:n]
 
 # == contiguous_notes ==
 # Closely line up the notes, stripping pauses and remove Staccato.
-def contiguous_notes (origtune, min_duration, max_duration):
-  tune = np.copy (origtune)
+def contiguous_notes (origtune, min_duration, max_duration, copy = True):
+  tune = np.copy (origtune) if copy else origtune
   last_duration = 1
   L = len (tune)
   if L:
@@ -407,20 +647,34 @@ def contiguous_notes (origtune, min_duration, max_duration):
 
 # == transpose_to_c ==
 # Transpose tune to C4 or C5, whichever is closer
-def transpose_to_c (origtune):
-  tune = np.copy (origtune)
+def transpose_to_c (origtune, copy = True):
+  tune = np.copy (origtune) if copy else origtune
   tstats = tune_stats (tune)
   if tstats.tonica > 0:
     octave = 0
     if tstats.min_note < 127 - tstats.max_note:
       octave = +12                                              # pick C5
-    for i,(p,d,s) in enumerate (tune):
-      pitch = p + octave - tstats.tonica                        # transpose into C4 or C5
-      if pitch < 0:   pitch += 12                               # constrain to MIDI range
-      if pitch > 127: pitch -= 12                               # constrain to MIDI range
-      tune[i][0] = pitch
+    pitches = tune[:,0] + (octave - tstats.tonica)              # transpose into C4 or C5
+    pitches[pitches < 0] += 12                                  # constrain to MIDI range
+    pitches[pitches > 127] -= 12                                # constrain to MIDI range
+    tune[:,0] = pitches
   return tune
 
+# == interval_ngrams ==
+# Pack `n` successive pitch intervals into integer keys, these are invariant under transposition.
+def interval_ngrams (notes, n = 4):
+  assert n >= 1 and n <= 8                                      # 8 bits per interval in a uint64
+  pitches = np.asarray (notes).reshape (-1, 3)[:,0].astype (np.int64)
+  intervals = (np.diff (pitches) + 128).astype (np.uint64)      # -127..+127 -> 1..255
+  L = len (intervals) - n + 1
+  keys = np.zeros (max (0, L), dtype = np.uint64)
+  for i in range (n if L > 0 else 0):
+    keys = (keys << np.uint64 (8)) | intervals[i:i + L]
+  return keys
+assert (interval_ngrams ([[60,1,0], [62,1,1], [64,1,1]], 2) == [0x8282]).all()
+assert (interval_ngrams ([[67,1,0], [69,1,1], [71,1,1]], 2) == interval_ngrams ([[60,1,0], [62,1,1], [64,1,1]], 2)).all()
+assert len (interval_ngrams ([[60,1,0]], 2)) == 0
+
 # == pds_array ==
 # Convert `tones` into a numpy.array with `(pitch, duration, step)` elements.
 def pds_array (tones):
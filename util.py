@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # This Source Code Form is licensed MPL-2.0: http://mozilla.org/MPL/2.0
-import sys, os
+import sys, os, time, collections
+import concurrent.futures
 
 # == Bunch ==
 class Bunch: # simplified object notation
@@ -36,3 +37,57 @@ def collect_files (where, extension = None, followlinks = True):
       collected.append (path)
   return collected
 
+# == prefetch_files ==
+# Read files with one bulk read each on `depth` threads ahead of consumption, yield `(path, data)` in order.
+# `data` is the OSError if reading failed. Each file's size is reserved against `max_bytes` when its read
+# is submitted and released when it is yielded, at least one read is always in flight. If given, `stats.files`, `stats.bytes`, `stats.io_wait` and `stats.read_time` are accumulated.
+def prefetch_files (paths, depth = 8, max_bytes = 64 << 20, stats = None):
+  def read (path):
+    t0 = time.perf_counter()
+    try:
+      with open (path, 'rb') as f:
+        data = f.read()
+    except OSError as ex:
+      data = ex
+    return data, time.perf_counter() - t0
+  def size_of (path):
+    try:
+      return os.path.getsize (path)
+    except OSError:
+      return 0                                                  # read() reports the error
+  def account (data, wait, read_time):
+    if stats:
+      stats.files += 1
+      stats.bytes += len (data) if isinstance (data, bytes) else 0
+      stats.io_wait += wait
+      stats.read_time += read_time
+  paths = iter (as_list (paths))
+  if depth <= 0:
+    for path in paths:
+      data, read_time = read (path)
+      account (data, read_time, read_time)
+      yield path, data
+    return
+  with concurrent.futures.ThreadPoolExecutor (depth) as pool:
+    pending, reserved, upcoming = collections.deque(), 0, None
+    while True:
+      while len (pending) < depth:
+        if upcoming is None:
+          path = next (paths, None)
+          if path is None:
+            break
+          upcoming = (path, size_of (path))
+        if pending and reserved + upcoming[1] > max_bytes:
+          break                                                 # wait for budget
+        path, size = upcoming
+        upcoming = None
+        pending.append ((path, size, pool.submit (read, path)))
+        reserved += size
+      if not pending:
+        return
+      path, size, future = pending.popleft()
+      reserved -= size
+      t0 = time.perf_counter()
+      data, read_time = future.result()
+      account (data, time.perf_counter() - t0, read_time)
+      yield path, data